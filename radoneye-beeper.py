@@ -11,10 +11,14 @@ class RadonEyeBeeper:
     COMMAND_BEEP = [0xA1, 0x11, 0x17, 0x0C, 0x0B, 0x01, 0x25, 0x28]
 
     async def beep(self, address, times):
+        command = bytearray(self.COMMAND_BEEP)
+
         async with BleakClient(address) as client:
             for x in range(times or 1):
-                await client.write_gatt_char(self.UUID_COMMAND, bytearray(self.COMMAND_BEEP))
-                await asyncio.sleep(1)
+                # pause between beeps so they are heard separately, not after the last one
+                if x > 0:
+                    await asyncio.sleep(1)
+                await client.write_gatt_char(self.UUID_COMMAND, command)
 
 
 async def main():
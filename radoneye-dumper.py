@@ -2,10 +2,9 @@
 
 import asyncio
 from binascii import hexlify
-from struct import unpack
+from struct import Struct, unpack_from
 from bleak import BleakClient
 from argparse import ArgumentParser
-import math
 
 
 class RadonEyeDumper:
@@ -16,6 +15,10 @@ class RadonEyeDumper:
     COMMAND_CURRENT = 0x40
     COMMAND_HISTORY = 0x41
 
+    # serial parts at 2, 8 and 11, model at 16, version at 22 and
+    # little-endian shorts at offsets 33, 35, 37, 39, 41, 43 and 51
+    CURRENT_DATA = Struct("<2x6s3s4sx6s6s5x6H6xH")
+
     def __init__(self, timeout) -> None:
         self.timeout = timeout
         pass
@@ -23,18 +26,13 @@ class RadonEyeDumper:
     def to_pci_l(self, value_bq_m3):
         return round(value_bq_m3 / 37, 2)
 
-    def read_short(self, data, start):
-        return unpack("<H", data[slice(start, start + 2)])[0]
-
-    def read_str(self, data, start, length):
-        return data[slice(start, start + length)].decode()
-
     def decode_history_data(self, data: bytearray):
-        command = data.pop(0)
-        page_count = data.pop(0)
-        page_no = data.pop(0)
-        value_count = data.pop(0)
-        values_bq_m3 = unpack("<" + "H" * (len(data) // 2), data)
+        data = bytes(data)
+        command = data[0]
+        page_count = data[1]
+        page_no = data[2]
+        value_count = data[3]
+        values_bq_m3 = unpack_from(f"<{(len(data) - 4) // 2}H", data, 4)
         values_pci_l = [self.to_pci_l(x) for x in values_bq_m3]
 
         if command != self.COMMAND_HISTORY:
@@ -43,7 +41,7 @@ class RadonEyeDumper:
             print("hmm: expected value count {} but found {}", value_count, len(values_bq_m3))
 
         if page_count == page_no:
-            self.history_done = True
+            self.history_done.set()
 
         return {
             "command": command,
@@ -55,24 +53,31 @@ class RadonEyeDumper:
         }
 
     def decode_current_data(self, data: bytearray):
-        serial = self.read_str(data, 8, 3) + self.read_str(data, 2, 6) + self.read_str(data, 11, 4)
-        model = self.read_str(data, 16, 6)
-        version = self.read_str(data, 22, 6)
-        latest_bq_m3 = self.read_short(data, 33)
+        data = bytes(data)
+        (
+            serial_mid,
+            serial_head,
+            serial_tail,
+            model,
+            version,
+            latest_bq_m3,
+            day_avg_bq_m3,
+            month_avg_bq_m3,
+            counts_current,
+            counts_previous,
+            uptime_minutes,
+            peak_bq_m3,
+        ) = self.CURRENT_DATA.unpack_from(data)
+        serial = (serial_head + serial_mid + serial_tail).decode("ascii")
+        model = model.decode("ascii")
+        version = version.decode("ascii")
         latest_pci_l = self.to_pci_l(latest_bq_m3)
-        day_avg_bq_m3 = self.read_short(data, 35)
         day_avg_pci_l = self.to_pci_l(day_avg_bq_m3)
-        month_avg_bq_m3 = self.read_short(data, 37)
         month_avg_pci_l = self.to_pci_l(month_avg_bq_m3)
-        counts_current = self.read_short(data, 39)
-        counts_previous = self.read_short(data, 41)
         counts_str = f"{counts_current}/{counts_previous}"
-        uptime_minutes = self.read_short(data, 43)
-        uptime_days = math.floor(uptime_minutes / (60 * 24))
-        uptime_hours = math.floor(uptime_minutes % (60 * 24) / 60)
-        uptime_mins = uptime_minutes % 60
+        uptime_days, uptime_rest = divmod(uptime_minutes, 60 * 24)
+        uptime_hours, uptime_mins = divmod(uptime_rest, 60)
         uptime_str = f"{uptime_days}d {uptime_hours:02}:{uptime_mins:02}"
-        peak_bq_m3 = self.read_short(data, 51)
         peak_pci_l = self.to_pci_l(peak_bq_m3)
 
         return {
@@ -95,8 +100,7 @@ class RadonEyeDumper:
         }
 
     async def dump(self, address):
-        self.countdown = self.timeout
-        self.history_done = False
+        self.history_done = asyncio.Event()
 
         def current_callback(sender: int, data: bytearray):
             print(
@@ -117,9 +121,10 @@ class RadonEyeDumper:
             await client.start_notify(self.UUID_HISTORY, history_callback)
             await client.write_gatt_char(self.UUID_COMMAND, bytearray([self.COMMAND_CURRENT]))
             await client.write_gatt_char(self.UUID_COMMAND, bytearray([self.COMMAND_HISTORY]))
-            while not self.history_done and self.countdown > 0:
-                await asyncio.sleep(1)
-                self.countdown -= 1
+            try:
+                await asyncio.wait_for(self.history_done.wait(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                pass
 
 
 async def main():
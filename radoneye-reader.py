@@ -11,40 +11,45 @@ import traceback
 import paho.mqtt.client as mqtt
 from bleak import BleakClient
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from struct import unpack
-from string import Template
-import math
+from struct import Struct
 
+logger = logging.getLogger(__name__)
 
-class RadonEyeParser:
-    def read_short(self, data: bytearray, start: int) -> int:
-        return unpack("<H", data[slice(start, start + 2)])[0]
 
-    def read_str(self, data: bytearray, start: int, length: int) -> str:
-        return data[slice(start, start + length)].decode()
+class RadonEyeParser:
+    # serial parts at 2, 8 and 11, model at 16, version at 22 and
+    # little-endian shorts at offsets 33, 35, 37, 39, 41, 43 and 51
+    CURRENT_DATA = Struct("<2x6s3s4sx6s6s5x6H6xH")
 
     def to_pci_l(self, value_bq_m3: int) -> float:
         return round(value_bq_m3 / 37, 2)
 
     def parse_sensor_data(self, data: bytearray) -> dict:
-        serial = self.read_str(data, 8, 3) + self.read_str(data, 2, 6) + self.read_str(data, 11, 4)
-        model = self.read_str(data, 16, 6)
-        version = self.read_str(data, 22, 6)
-        latest_bq_m3 = self.read_short(data, 33)
+        data = bytes(data)
+        (
+            serial_mid,
+            serial_head,
+            serial_tail,
+            model,
+            version,
+            latest_bq_m3,
+            day_avg_bq_m3,
+            month_avg_bq_m3,
+            counts_current,
+            counts_previous,
+            uptime_minutes,
+            peak_bq_m3,
+        ) = self.CURRENT_DATA.unpack_from(data)
+        serial = (serial_head + serial_mid + serial_tail).decode("ascii")
+        model = model.decode("ascii")
+        version = version.decode("ascii")
         latest_pci_l = self.to_pci_l(latest_bq_m3)
-        day_avg_bq_m3 = self.read_short(data, 35)
         day_avg_pci_l = self.to_pci_l(day_avg_bq_m3)
-        month_avg_bq_m3 = self.read_short(data, 37)
         month_avg_pci_l = self.to_pci_l(month_avg_bq_m3)
-        counts_current = self.read_short(data, 39)
-        counts_previous = self.read_short(data, 41)
         counts_str = f"{counts_current}/{counts_previous}"
-        uptime_minutes = self.read_short(data, 43)
-        uptime_days = math.floor(uptime_minutes / (60 * 24))
-        uptime_hours = math.floor(uptime_minutes % (60 * 24) / 60)
-        uptime_mins = uptime_minutes % 60
+        uptime_days, uptime_rest = divmod(uptime_minutes, 60 * 24)
+        uptime_hours, uptime_mins = divmod(uptime_rest, 60)
         uptime_str = f"{uptime_days}d {uptime_hours:02}:{uptime_mins:02}"
-        peak_bq_m3 = self.read_short(data, 51)
         peak_pci_l = self.to_pci_l(peak_bq_m3)
 
         return {
@@ -81,8 +86,10 @@ class RadonEyeReader:
         self.connect_timeout = connect_timeout
         self.read_timeout = read_timeout
         self.parser = RadonEyeParser()
+        self.client = None
+        self.future = None
 
-    def decode_sensor_data(self, data: bytearray):
+    def decode_sensor_data(self, data: bytes):
         return {
             "timestamp": str(datetime.datetime.now()),
             "vendor": self.VENDOR,
@@ -91,36 +98,43 @@ class RadonEyeReader:
             **self.parser.parse_sensor_data(data),
         }
 
-    async def read_sensor_data(self) -> dict:
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
+    def handle_sensor_data(self, sender: int, data: bytearray):
+        # only capture the packet, it is decoded by the awaiting reader
+        if self.future is not None and not self.future.done():
+            self.future.set_result(bytes(data))
+
+    async def connect(self):
+        if self.client is not None and self.client.is_connected:
+            return
+
+        self.client = BleakClient(self.address, timeout=self.connect_timeout)
+        await self.client.connect()
+        await self.client.start_notify(self.UUID_CURRENT, self.handle_sensor_data)
+
+    async def disconnect(self):
+        if self.client is None:
+            return
+
+        client = self.client
+        self.client = None
+        try:
+            await client.disconnect()
+        except Exception:
+            # connection is being dropped anyway, next read will reconnect
+            pass
+
+    async def read(self) -> dict:
+        self.future = asyncio.get_running_loop().create_future()
+        await self.client.write_gatt_char(self.UUID_COMMAND, bytearray([self.COMMAND_CURRENT]))
+        data = await asyncio.wait_for(self.future, timeout=self.read_timeout)
+        return self.decode_sensor_data(data)
 
-        def callback(sender: int, data: bytearray):
-            future.set_result(self.decode_sensor_data(data))
-
-        async with BleakClient(self.address, timout=self.connect_timeout) as client:
-            await client.start_notify(self.UUID_CURRENT, callback)
-            await client.write_gatt_char(self.UUID_COMMAND, bytearray([self.COMMAND_CURRENT]))
-            return await asyncio.wait_for(future, timeout=self.read_timeout)
+    async def read_sensor_data(self) -> dict:
+        await self.connect()
+        return await self.read()
 
 
 class RadonEyeReaderApp:
-    DISCOVERY_EVENT_TEMPLATE = {
-        "name": "$vendor $model $serial $attr",
-        "unit_of_measurement": "$unit",
-        "value_template": "{{ value }}",
-        "state_class": "measurement",
-        "state_topic": "$state_topic/$state_name",
-        "unique_id": "$vendor-$model-$serial-$attr",
-        "icon": "mdi:radioactive",
-        "device": {
-            "identifiers": "$vendor-$model-$serial",
-            "name": "$vendor $model $serial",
-            "model": "$model",
-            "manufacturer": "$vendor",
-        },
-    }
-
     DISCOVERY_ATTRIBUTES = [
         {"id": "latest_pci_l", "name": "Latest", "unit": "pCi/L"},
         {"id": "day_avg_pci_l", "name": "DayAvg", "unit": "pCi/L"},
@@ -132,6 +146,13 @@ class RadonEyeReaderApp:
         self.args = self.parse_args()
         if self.args.debug:
             logging.basicConfig(level=logging.DEBUG)
+        self.hostname = socket.gethostname()
+        self.device_topics = {}
+        self.device_attr_topics = {}
+        self.device_published = {}
+        self.discovery_events = {}
+        self.discovery_sent = set()
+        self.restart_bluetooth_task = None
 
     def parse_args(self):
         parser = ArgumentParser(
@@ -178,7 +199,22 @@ class RadonEyeReaderApp:
         )
         parser.add_argument("--device-retain", action="store_true", help="retain device events")
         parser.add_argument(
-            "--discovery-retain", action="store_true", help="retain discovery events"
+            "--device-json",
+            action="store_true",
+            help="publish device event as a single JSON payload to device topic",
+        )
+        parser.add_argument(
+            "--device-changed-only",
+            action="store_true",
+            help=(
+                "publish only changed device values, requires --device-retain, ignored with"
+                " --device-json, --force-update or --expire-after"
+            ),
+        )
+        parser.add_argument(
+            "--discovery-retain",
+            action="store_true",
+            help="retain discovery events and publish them only once per device",
         )
         parser.add_argument(
             "--discovery-delay",
@@ -234,7 +270,7 @@ class RadonEyeReaderApp:
 
     def mqtt_init(self):
         if self.args.mqtt:
-            self.mqttc = mqtt.Client("radoneye_{hostname}".format(hostname=socket.gethostname()))
+            self.mqttc = mqtt.Client(f"radoneye_{self.hostname}")
 
             if self.args.debug:
                 self.mqttc.enable_logger()
@@ -245,45 +281,131 @@ class RadonEyeReaderApp:
             if self.args.mqtt_ca_cert is not None:
                 self.mqttc.tls_set(ca_certs=self.args.mqtt_ca_cert)
 
+            self.mqttc.on_socket_open = self.mqtt_socket_open
+            self.mqttc.on_connect = self.mqtt_connect
+            self.loop = asyncio.get_running_loop()
+
             self.mqttc.connect_async(self.args.mqtt_hostname, self.args.mqtt_port)
 
             self.mqttc.loop_start()
 
-    def publish_device_event(self, data):
-        device_topic = self.args.device_topic.format(**data, hostname=socket.gethostname())
-
-        for key, value in data.items():
-            self.mqttc.publish(device_topic + "/" + key, value, retain=self.args.device_retain)
-
-    def publish_discovery_event(self, data):
-        device_topic = self.args.device_topic.format(**data, hostname=socket.gethostname())
+    def mqtt_socket_open(self, client, userdata, sock):
+        # send small publish packets right away instead of letting Nagle's algorithm hold them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def mqtt_connect(self, client, userdata, flags, rc):
+        # called from paho network thread, state is owned by event loop thread
+        if rc == mqtt.CONNACK_ACCEPTED:
+            self.loop.call_soon_threadsafe(self.reset_published_state)
+
+    def reset_published_state(self):
+        # broker could have lost retained messages and paho drops queued ones on reconnect
+        self.discovery_sent.clear()
+        self.device_published.clear()
+
+    def build_discovery_event(self, data, attr):
+        device_topic = self.get_device_topic(data)
+        device_id = "{vendor}-{model}-{serial}".format(**data)
+        device_name = "{vendor} {model} {serial}".format(**data)
+
+        if self.args.device_json:
+            value_template = "{{ value_json." + attr["id"] + " }}"
+            state_topic = device_topic
+        else:
+            value_template = "{{ value }}"
+            state_topic = f"{device_topic}/{attr['id']}"
+
+        event = {
+            "name": f"{device_name} {attr['name']}",
+            "unit_of_measurement": attr["unit"],
+            "value_template": value_template,
+            "state_class": "measurement",
+            "state_topic": state_topic,
+            "unique_id": f"{device_id}-{attr['name']}",
+            "icon": "mdi:radioactive",
+            "device": {
+                "identifiers": device_id,
+                "name": device_name,
+                "model": data["model"],
+                "manufacturer": data["vendor"],
+            },
+        }
+        if self.args.force_update:
+            event.update({"force_update": "true"})
+        if self.args.expire_after:
+            event.update({"expire_after": self.args.expire_after})
+
+        return event
+
+    def get_device_key(self, data):
+        return (data["vendor"], data["model"], data["serial"])
+
+    def get_device_topic(self, data):
+        # device topic could only depend on values that are stable for the device
+        key = self.get_device_key(data)
+        if key not in self.device_topics:
+            self.device_topics[key] = self.args.device_topic.format(**data, hostname=self.hostname)
+        return self.device_topics[key]
+
+    def get_device_attr_topics(self, data):
+        # sensor data always has the same set of attributes
+        key = self.get_device_key(data)
+        if key not in self.device_attr_topics:
+            device_topic = self.get_device_topic(data)
+            self.device_attr_topics[key] = [(attr, f"{device_topic}/{attr}") for attr in data]
+        return self.device_attr_topics[key]
 
-        for attr in self.DISCOVERY_ATTRIBUTES:
-            discovery_topic = (
-                self.args.discovery_topic
-                + "/{vendor}-{model}-{serial}/{vendor}-{model}-{serial}-{attr}/config".format(
-                    **data, attr=attr.get("name")
+    def publish_device_event(self, data):
+        if self.args.device_json:
+            device_topic = self.get_device_topic(data)
+            self.mqttc.publish(device_topic, json.dumps(data), retain=self.args.device_retain)
+            return
+
+        # retained values stay on broker, unchanged ones are only needed if state could expire
+        skip_unchanged = (
+            self.args.device_changed_only
+            and self.args.device_retain
+            and not self.args.force_update
+            and not self.args.expire_after
+        )
+        published = self.device_published.setdefault(self.get_device_key(data), {})
+
+        for attr, attr_topic in self.get_device_attr_topics(data):
+            value = data[attr]
+            if skip_unchanged and attr in published and published[attr] == value:
+                continue
+
+            info = self.mqttc.publish(attr_topic, value, retain=self.args.device_retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                published[attr] = value
+
+    def get_discovery_events(self, data):
+        # discovery events only depend on values that are stable for the device
+        key = self.get_device_key(data)
+        if key not in self.discovery_events:
+            device_id = "{vendor}-{model}-{serial}".format(**data)
+            self.discovery_events[key] = [
+                (
+                    f"{self.args.discovery_topic}/{device_id}/{device_id}-{attr['name']}/config",
+                    json.dumps(self.build_discovery_event(data, attr)),
                 )
-            )
+                for attr in self.DISCOVERY_ATTRIBUTES
+            ]
+        return self.discovery_events[key]
 
-            event_template = self.DISCOVERY_EVENT_TEMPLATE.copy()
-            if self.args.force_update:
-                event_template.update({"force_update": "true"})
-            if self.args.expire_after:
-                event_template.update({"expire_after": self.args.expire_after})
-
-            discovery_event = Template(json.dumps(event_template)).substitute(
-                **data,
-                attr=attr.get("name"),
-                unit=attr.get("unit"),
-                state_topic=device_topic,
-                state_name=attr.get("id"),
+    def publish_discovery_event(self, data) -> bool:
+        published = True
+
+        for discovery_topic, discovery_event in self.get_discovery_events(data):
+            info = self.mqttc.publish(
+                discovery_topic, discovery_event, retain=self.args.discovery_retain
             )
+            published = published and info.rc == mqtt.MQTT_ERR_SUCCESS
 
-            self.mqttc.publish(discovery_topic, discovery_event, retain=self.args.discovery_retain)
+        return published
 
     def print_sensor_data(self, data):
-        print("{}".format(json.dumps(data)), flush=True)
+        print(json.dumps(data), flush=True)
 
     def str_err(self, error: Exception):
         type_str = type(error).__name__
@@ -302,8 +424,7 @@ class RadonEyeReaderApp:
         if attempt < self.args.attempts:
             # restart bluetooth before last attempt if enabled
             if attempt == self.args.attempts - 1 and self.args.restart_bluetooth:
-                self.restart_bluetooth_stack()
-                await asyncio.sleep(self.args.restart_bluetooth_delay)
+                await self.restart_bluetooth_stack()
             # otherwise just wait
             else:
                 await asyncio.sleep(self.args.reconnect_delay)
@@ -324,70 +445,101 @@ class RadonEyeReaderApp:
             flush=True,
         )
 
-    def restart_bluetooth_stack(self):
-        print(
-            "WARNING: Restarting bluetooth stack...",
-            file=sys.stderr,
-            flush=True,
-        )
-        os.system(self.args.restart_bluetooth_cmd)
+    async def restart_bluetooth_stack(self):
+        # devices failing at the same time share a single restart instead of starting their own
+        if self.restart_bluetooth_task is None:
+            self.restart_bluetooth_task = asyncio.ensure_future(self.exec_restart_bluetooth_cmd())
+        await asyncio.shield(self.restart_bluetooth_task)
+
+    async def wait_bluetooth_restart(self):
+        # connecting while bluetooth stack is restarting is doomed to fail
+        if self.restart_bluetooth_task is not None:
+            await asyncio.shield(self.restart_bluetooth_task)
+
+    async def exec_restart_bluetooth_cmd(self):
+        try:
+            print(
+                "WARNING: Restarting bluetooth stack...",
+                file=sys.stderr,
+                flush=True,
+            )
+            # run through shell to support any command, without blocking the event loop
+            proc = await asyncio.create_subprocess_shell(self.args.restart_bluetooth_cmd)
+            await proc.wait()
+            await asyncio.sleep(self.args.restart_bluetooth_delay)
+        finally:
+            self.restart_bluetooth_task = None
+
+    async def read_device(self, reader: RadonEyeReader):
+        address = reader.address
+
+        logger.info("DEV %s: reading device sensor data", address)
+
+        for attempt in range(1, self.args.attempts + 1):
+            await self.wait_bluetooth_restart()
+            try:
+                return await reader.read_sensor_data()
+            except Exception as error:
+                await reader.disconnect()
+                await self.handle_sensor_error(address, error, attempt)
+                if self.args.debug:
+                    traceback.print_exc(file=sys.stderr)
+
+        return None
 
     async def run(self):
         if self.args.mqtt:
             self.mqtt_init()
 
-        while True:
-            for address in self.args.addresses:
-                print(
-                    f"INFO: DEV {address}: reading device sensor data", file=sys.stderr, flush=True
-                )
+        # connections are kept open between polls and reestablished only after errors
+        readers = {
+            address: RadonEyeReader(address, self.args.connect_timeout, self.args.read_timeout)
+            for address in self.args.addresses
+        }
 
-                reader = RadonEyeReader(address, self.args.connect_timeout, self.args.read_timeout)
-
-                data = None
-
-                attempt = 1
-                while attempt > 0 and attempt <= self.args.attempts:
-                    try:
-                        data = await asyncio.wait_for(
-                            reader.read_sensor_data(),
-                            timeout=self.args.connect_timeout + self.args.read_timeout,
-                        )
-                        attempt = 0
-                    except Exception as error:
-                        await self.handle_sensor_error(address, error, attempt)
-                        if self.args.debug:
-                            traceback.print_exc(file=sys.stderr)
-                        attempt = attempt + 1
-
-                if data is not None:
-                    self.print_sensor_data(data)
-
-                if data is not None and self.args.mqtt and self.args.discovery:
-                    try:
-                        self.publish_discovery_event(data)
-                        await asyncio.sleep(self.args.discovery_delay)
-                    except Exception as error:
-                        self.handle_discovery_event_error(address, error)
-
-                if data is not None and self.args.mqtt:
-                    try:
-                        self.publish_device_event(data)
-                    except Exception as error:
-                        self.handle_device_event_error(address, error)
-
-            if self.args.daemon:
-                print(
-                    f"INFO: sleeping for {self.args.interval} sec...",
-                    file=sys.stderr,
-                    flush=True,
+        try:
+            while True:
+                # devices are independent, so they are polled concurrently
+                results = await asyncio.gather(
+                    *(self.read_device(reader) for reader in readers.values())
                 )
-                await asyncio.sleep(self.args.interval)
-            else:
-                break
 
-        if self.args.mqtt:
-            self.mqttc.loop_stop()
+                for address, data in zip(readers, results):
+                    if data is not None:
+                        self.print_sensor_data(data)
+
+                    if (
+                        data is not None
+                        and self.args.mqtt
+                        and self.args.discovery
+                        and self.get_device_key(data) not in self.discovery_sent
+                    ):
+                        try:
+                            # retained discovery events stay on broker, no need to repeat them
+                            if self.publish_discovery_event(data) and self.args.discovery_retain:
+                                self.discovery_sent.add(self.get_device_key(data))
+                            await asyncio.sleep(self.args.discovery_delay)
+                        except Exception as error:
+                            self.handle_discovery_event_error(address, error)
+
+                    if data is not None and self.args.mqtt:
+                        try:
+                            self.publish_device_event(data)
+                        except Exception as error:
+                            self.handle_device_event_error(address, error)
+
+                if self.args.daemon:
+                    logger.info("sleeping for %s sec...", self.args.interval)
+                    await asyncio.sleep(self.args.interval)
+                else:
+                    break
+        finally:
+            # leave devices and broker in a clean state also when interrupted
+            for reader in readers.values():
+                await reader.disconnect()
+
+            if self.args.mqtt:
+                self.mqttc.loop_stop()
 
 
 async def main():